@@ -0,0 +1,29 @@
+# Query the link graph saved by the last run of weakest_link.py
+# python3 backlinks.py /path/to/file.html - who links to this file?
+# python3 backlinks.py --from /path/to/page.html - what does this page link to?
+# Targets are site paths for internal links (as in weakest_link.log) and full
+# URLs for everything else.
+import sqlite3
+import sys
+
+db = sqlite3.connect("weakest_link.db")
+
+def variants(fn):
+	# A directory and its index file are the same thing as far as links go
+	if fn.endswith("/"): return fn, fn + "index.html"
+	if fn.endswith("/index.html"): return fn, fn.removesuffix("index.html")
+	return fn,
+
+args = sys.argv[1:]
+if not args:
+	print("USAGE: python3 backlinks.py [--from] fn [fn...]", file=sys.stderr)
+	sys.exit(1)
+if args[0] == "--from":
+	query = "select target, attr from links where source = ? order by target"
+	args = args[1:]
+else:
+	query = "select source, attr from links where target = ? order by source"
+for arg in args:
+	for fn in variants(arg):
+		for other, attr in db.execute(query, (fn,)):
+			print(fn, other, attr, sep="\t")
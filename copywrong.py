@@ -19,8 +19,10 @@
 import os
 import re
 import sys
+import time
 import collections
-from bs4 import BeautifulSoup, Comment, Tag
+import multiprocessing
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
 
 root = "/home/rosuav/gsarchive/live"
 # Faster and safer, not touching the original files
@@ -38,6 +40,23 @@ copyright = re.compile(r"""
 	.*(All\s*R[io]ghts\s*Reserved)?
 """, re.IGNORECASE | re.VERBOSE | re.DOTALL)
 
+# The pattern above, pulled apart so it can't backtrack. With a greedy .* and an
+# optional group at the end, a match always runs from the first marker to the end
+# of the text, and the middle just has to find an owner somewhere after that
+# marker. So: find the first marker, look for an owner after it, done.
+copyright_marker = re.compile(r"C?opyright|©", re.IGNORECASE)
+copyright_owner = re.compile(r"""
+	Gilber[e]?t\s*(and|&)\s*Sulliv[ae]n\s*Arch[i]?ve
+	| Paul\s*Howarth
+	| Colin\s*Johnson
+""", re.IGNORECASE | re.VERBOSE)
+rest_of_text = re.compile(".*", re.DOTALL)
+
+def find_copyright(text):
+	# Same result as copyright.search(text), in linear time
+	if (m := copyright_marker.search(text)) and copyright_owner.search(text, m.end()):
+		return rest_of_text.match(text, m.start())
+
 just_a_date = re.compile(r"""^
 \s*(Date\s*)?(Page\s*)?(modified|cr[ea]{2}ted|u[p]?dated)?
 \s*(?P<day>[0-9]{1,2})			# Day
@@ -56,18 +75,20 @@ footer = """<footer class="standalone">
 <p class="copyright"><a rel="license" href="https://creativecommons.org/licenses/by-sa/4.0/"><img alt="Creative Commons License" style="border-width:0" src="https://i.creativecommons.org/l/by-sa/4.0/88x31.png"></a>
  This work is licensed under a <BR> <a rel="license" href="https://creativecommons.org/licenses/by-sa/4.0/">Creative Commons Attribution-ShareAlike 4.0 International License</a>.</p>
 </footer>"""
-def write_back(fn, soup):
+def write_back(fn, soup, blob):
 	#print("WRITEBACK:", fn); return # bail
 	if not soup.find("footer"):
 		soup.body.append(BeautifulSoup(footer, "html.parser"))
 		if not soup.find("link", href="/styles/gsarchive.css"):
 			soup.head.append(BeautifulSoup('<link href="/styles/gsarchive.css" rel="stylesheet" type="text/css">', "html.parser"))
 	data = soup.encode(formatter="html5")
+	if data == blob: return # Round-tripped to the same bytes, so leave the file (and its mtime) alone
 	with open(fn, "wb") as f: f.write(data)
 
 def classify_residue(cr, m, info):
 	par = cr.parent
-	cr.replace_with(cr.text[:m.start()], cr.text[m.end():])
+	before, after = NavigableString(cr.text[:m.start()]), NavigableString(cr.text[m.end():])
+	cr.replace_with(before, after)
 	text = par.text
 	# Figure out what else is in this blob.
 	if m := just_a_date.match(text):
@@ -80,12 +101,24 @@ def classify_residue(cr, m, info):
 	if midi_files.match(text): return "MIDI files"
 	if blank.match(text): return "Blank"
 	info["text"] = text
+	# Not something we can fix, so put the notice back; the page may still get
+	# written out for other reasons, and this mustn't go along with it.
+	before.replace_with(cr)
+	after.extract()
 	return "UNKNOWN"
 
 def classify(fn):
-	info = {"copyright": set()}
 	with open(fn, "rb") as f: blob = f.read()
 	soup = BeautifulSoup(blob, "html5lib")
+	# Fixes accumulate on the soup; however many there were, the page gets
+	# encoded and written just once, at the end.
+	changes = []
+	info = classify_soup(soup, changes)
+	if changes: write_back(fn, soup, blob)
+	return info
+
+def classify_soup(soup, changes):
+	info = {"copyright": set()}
 	if soup.noframes: return {"copyright": {"Skip"}} # Can't fix, and not worth trying to fix, frames/noframes splits
 	if soup.find(string=lambda text: isinstance(text, Comment) and "autogenerated" in text.lower()):
 		info["generated"] = 1
@@ -100,15 +133,15 @@ def classify(fn):
 		else: info.setdefault("links", []).append(tag["href"])
 	if "links" in info:
 		info["copyright"].add("Unknown Link")
-	if "CC-BY-SA 4.0 non-SSL" in info["copyright"]: # There could be more than one, so write back just once
-		write_back(fn, soup)
+	if "CC-BY-SA 4.0 non-SSL" in info["copyright"]:
+		changes.append("SSL")
 	text = []
 	for cr in soup.findAll(string=True):
-		if m := copyright.search(cr.text):
+		if m := find_copyright(cr.text):
 			residue = classify_residue(cr, m, info)
 			if residue != "UNKNOWN":
 				# Page content has been fixed. Let's tidy this up.
-				write_back(fn, soup)
+				changes.append("Corrected")
 				info["copyright"].add("Corrected")
 			else:
 				info["copyright"].add("All Rights Reserved")
@@ -123,7 +156,7 @@ def classify(fn):
 				# not to the same value. Would be nice to use the same
 				# format and CSS everywhere at least.
 				info["copyright"].add("David Stone")
-			elif m := copyright.search(cr.parent.text):
+			elif m := find_copyright(cr.parent.text):
 				# Fixing this is going to be harder. But it's still an ARR
 				# copyright notice, or possibly just a reference that's
 				# subsequently followed by "G&S Archive" or similar.
@@ -132,11 +165,11 @@ def classify(fn):
 			else: text.append(cr.text)
 	if not text:
 		if "CC-BY-SA 4.0" not in info["copyright"] and "CC-BY-SA 4.0 non-SSL" not in info["copyright"]:
-			write_back(fn, soup)
+			changes.append("Added")
 			info["copyright"].add("Added")
 		return info
 	if not info["copyright"]: # No recognized copyright notice, but possibly the word "copyright" used in a sentence
-		write_back(fn, soup)
+		changes.append("Added")
 		info["copyright"].add("Added")
 	else:
 		# References to copyright are going to be everywhere; it's okay to have them, as long as we also have
@@ -144,35 +177,89 @@ def classify(fn):
 		info["copyright"].add("Word 'copyright'")
 	return info | {"text": text}
 
+# Awkward cases for the copyright matcher, in addition to whatever the site has
+matcher_samples = [
+	"Copyright © 2003 Gilbert and Sullivan Archive. All Rights Reserved",
+	"copyright gilbert&sullivanarchve", "COPYRIGHT PAUL HOWARTH", "Xopyright Colin Johnson",
+	"Colin Johnson, Copyright 2001", "Copyright Colin Johnson and copyright Paul Howarth",
+	"©©©© Gilbert  and  Sullivan  Archive", "Copyright\n\nPaul\n\tHowarth\n", "Paul Howarth",
+	"Gilbert and Sullivan Archive ©", "Copyright " + "Paul " * 2000, "© " * 3000,
+	"© " * 3000 + "Colin Johnson", "Copyrigh Colin Johnson", "",
+]
+
+def check_matcher(files):
+	# Prove that find_copyright() agrees with the copyright regex on every string
+	# that classify() might search (all text nodes and their parents' text), and
+	# time the two.
+	texts = list(matcher_samples)
+	for fn in files:
+		with open(fn, "rb") as f: soup = BeautifulSoup(f.read(), "html5lib")
+		for cr in soup.find_all(string=True):
+			texts.append(cr.text)
+			if cr.parent: texts.append(cr.parent.text)
+	def span(m): return m and m.span()
+	for label, search in ("Regex", copyright.search), ("Matcher", find_copyright):
+		start = time.perf_counter()
+		for text in texts: search(text)
+		print("%s: %d strings in %.3fs" % (label, len(texts), time.perf_counter() - start))
+	wrong = [text for text in texts if span(copyright.search(text)) != span(find_copyright(text))]
+	for text in wrong: print("MISMATCH", repr(text[:200]))
+	print("%d mismatches" % len(wrong))
+
+def html_files():
+	for base, dirs, files in os.walk(root):
+		if "whowaswho" in dirs: dirs.remove("whowaswho")
+		if "backups" in dirs: dirs.remove("backups")
+		for file in files:
+			if not file.endswith(".html") and not file.endswith(".htm"): continue
+			yield os.path.join(base, file)
+
+# With -jN, files get classified (and fixed) in N worker processes; -j alone
+# uses one per CPU. All the tallying and logging still happens here.
+# --check-matcher [file...] compares the copyright matchers (see above) on the
+# given files, or on the whole site, and changes nothing.
+if sys.argv[1:2] == ["--check-matcher"]:
+	check_matcher(sys.argv[2:] or html_files())
+	sys.exit(0)
+
+workers = 0
 for fn in sys.argv[1:]:
+	if fn.startswith("-j"):
+		workers = int(fn[2:] or os.cpu_count())
+		continue
 	if os.path.exists(fn):
 		print(classify(fn))
 		sys.exit(0)
 
+def classify_file(fn):
+	try: return fn, classify(fn)
+	except: print(fn); raise
+
 stats = collections.Counter()
 residues = collections.Counter()
 known_types = {"CC-BY-SA 4.0", "David Stone", "Word 'copyright'", "Word 'copyright' + Archive", "Skip"}
+def tally(fn, info):
+	for c in info["copyright"]: stats[c] += 1
+	stats["Total"] += 1
+	if "CC-BY-SA 4.0" not in info["copyright"]:
+		#print(info["copyright"])
+		stats["No-CC " + ",".join(sorted(info["copyright"]))] += 1
+	if not stats["Total"] % 1000: print(stats)
+	if "All Rights Reserved" in info["copyright"]:
+		if info["residue"] == "UNKNOWN": print(fn, info, file=log)
+		residues[info["residue"]] += 1
+	elif info["copyright"] - known_types:
+		print(fn, info)
+		known_types.update(info["copyright"])
+
 with open("copywrong.log", "w") as log:
-	for root, dirs, files in os.walk(root):
-		if "whowaswho" in dirs: dirs.remove("whowaswho")
-		if "backups" in dirs: dirs.remove("backups")
-		for file in files:
-			if not file.endswith(".html") and not file.endswith(".htm"): continue
-			fn = os.path.join(root, file)
-			try: info = classify(fn)
-			except: print(fn); raise
-			for c in info["copyright"]: stats[c] += 1
-			stats["Total"] += 1
-			if "CC-BY-SA 4.0" not in info["copyright"]:
-				#print(info["copyright"])
-				stats["No-CC " + ",".join(sorted(info["copyright"]))] += 1
-			if not stats["Total"] % 1000: print(stats)
-			if "All Rights Reserved" in info["copyright"]:
-				if info["residue"] == "UNKNOWN": print(fn, info, file=log)
-				residues[info["residue"]] += 1
-			elif info["copyright"] - known_types:
-				print(fn, info)
-				known_types.update(info["copyright"])
+	if workers:
+		# Forked, not spawned, as a spawned worker would rerun this whole script.
+		with multiprocessing.get_context("fork").Pool(workers) as pool:
+			for fn, info in pool.imap_unordered(classify_file, html_files(), chunksize=8):
+				tally(fn, info)
+	else:
+		for fn in html_files(): tally(*classify_file(fn))
 print(stats)
 print(residues.total(), residues)
 
@@ -31,8 +31,13 @@
 import os
 import sys
 import re
+import time
+import json
 import hashlib
+import functools
 import collections
+import sqlite3
+import multiprocessing
 from bs4 import BeautifulSoup, Comment
 from urllib.parse import urlparse, urljoin, unquote, ParseResult
 import esprima # ImportError? pip install -r requirements.txt
@@ -40,6 +45,13 @@ import esprima # ImportError? pip install -r requirements.txt
 # root = "/home/rosuav/gsarchive/live"
 root = "/home/rosuav/gsarchive/clone"
 
+# The same few snippets of JS (setStatus boilerplate, MM_nbGroup and friends) turn
+# up on thousands of pages, so classifications are cached by the JS text. Set a
+# file name here to keep them from one run to the next as well; since the
+# classifiers live in this script, any edit to it invalidates that file.
+JS_CACHE_SIZE = 4096
+JS_CACHE_FILE = None # eg "popgoes_js.json"
+
 JS_FORMATS = {
 	"*Blank": "^$",
 	"Close window": r"^window.close\(\)$",
@@ -93,18 +105,39 @@ def find_func_args(expr, fnprefix):
 	# Otherwise, we got nuffin'.
 	return None, None
 
-def classify_link(elem, js):
-	info = {"attrs": ",".join(sorted(elem.attrs))}
-	for id, regex in JS_FORMATS.items():
-		if regex.match(js): return info | {"type": id}
+# Nearly every javascript: link is a plain openPopImg('x.jpg','Caption',w,h) or
+# openPopWin(...) with literal arguments, and those can be picked apart without
+# a full parse. Only the forms whose value is unambiguous are taken: strings with
+# no escapes or line breaks, and integers with no sign, fraction, or leading zero
+# (esprima reads 010 as octal), short enough to be exact. Anything else, such as
+# -3 or 300.5 or an expression, goes to esprima.
+js_ws = r"[ \t\r\n]*"
+js_literal = re.compile(r"""'[^'\\\r\n\u2028\u2029]*'|"[^"\\\r\n\u2028\u2029]*"|0|[1-9][0-9]{0,14}""")
+simple_popup = re.compile(rf"""{js_ws}(openPop[A-Za-z0-9_$]*){js_ws}\(
+	({js_ws}(?:(?:{js_literal.pattern}){js_ws},{js_ws})*(?:{js_literal.pattern}){js_ws})?
+\){js_ws};?{js_ws}""", re.VERBOSE)
+
+def simple_popup_args(js):
+	if m := simple_popup.fullmatch(js):
+		# Only literals, commas and whitespace in here, so the literals can just be found in order.
+		return m[1], [a[1:-1] if a[0] in "'\"" else int(a) for a in js_literal.findall(m[2] or "")]
+	return None, None
+
+def esprima_popup_args(js):
 	with ExceptionContext("JS code", js):
 		expr = esprima.parse(js)
 	# TODO: Recognize if there's any other code here (unlikely but possible)
-	fn, args = find_func_args(expr, "openPop")
-	if fn: return info | {"type": fn, "args": args}
-	return info | {"type": "Unknown"}
+	return find_func_args(expr, "openPop")
 
-def classify_hover(elem, js):
+def classify_link_js(js):
+	for id, regex in JS_FORMATS.items():
+		if regex.match(js): return {"type": id}
+	fn, args = simple_popup_args(js)
+	if not fn: fn, args = esprima_popup_args(js)
+	if fn: return {"type": fn, "args": args}
+	return {"type": "Unknown"}
+
+def classify_hover_js(js):
 	for id, regex in JS_FORMATS.items():
 		if regex.match(js): return {"type": id}
 	# esprima doesn't like a bare return statement. I'm not entirely sure how this is meant
@@ -120,27 +153,152 @@ def classify_hover(elem, js):
 		if fn: return {"type": findme}
 	return {"type": "Unknown", "js": str(expr)}
 
+js_classifiers = {"link": classify_link_js, "hover": classify_hover_js}
+with open(__file__, "rb") as f: js_source_stamp = hashlib.sha1(f.read()).hexdigest()
+js_disk_cache = {kind: { } for kind in js_classifiers}
+if JS_CACHE_FILE:
+	try:
+		with open(JS_CACHE_FILE) as f: cache = json.load(f)
+		if cache["source"] == js_source_stamp: js_disk_cache = cache["results"]
+	except FileNotFoundError: pass
+js_cache_stats = collections.Counter()
+
+# Results are shared between every element with the same JS, so callers must
+# not mutate them.
+@functools.lru_cache(maxsize=JS_CACHE_SIZE)
+def classify_js(kind, js):
+	if js in js_disk_cache[kind]:
+		js_cache_stats["Disk"] += 1
+		return js_disk_cache[kind][js]
+	js_cache_stats["Parsed"] += 1
+	info = js_classifiers[kind](js)
+	if JS_CACHE_FILE:
+		js_disk_cache[kind][js] = info
+		if worker: handback["js"].append((kind, js, info))
+	return info
+
+def classify_link(elem, js):
+	return {"attrs": ",".join(sorted(elem.attrs))} | classify_js("link", js)
+
+def classify_hover(elem, js):
+	return classify_js("hover", js)
+
 def make_popup(elem):
 	classes = elem.get("class")
 	if classes is None: elem["class"] = "popup"
 	elif "popup" not in classes: classes.append("popup")
 
+def link_js(href):
+	"""Return the code of a javascript: link, or None if it isn't one"""
+	p = urlparse(href)
+	if p.scheme.lower() != "javascript": return None
+	# When a question mark appears in the JS, browsers actually interpret it
+	# as the beginning of query parameters, as the apostrophe does not quote
+	# it. For our purposes, though, it's cleaner to simply rejoin that.
+	js = p.path
+	if p.query: js += "?" + p.query
+	return js
+
+def html_files():
+	for base, dirs, files in os.walk(root):
+		if "backups" in dirs: dirs.remove("backups")
+		for file in files:
+			if not file.endswith(".html") and not file.endswith(".htm"): continue
+			yield os.path.join(base, file)
+
+# Awkward cases for the openPop* fast path, in addition to whatever the site has
+args_samples = [
+	"openPopImg('a.jpg','Caption',300,400)", 'openPopImg("Gilbert\'s.jpg", "It\'s")', "openPopImg('a\\'b.jpg')",
+	" openPopWin ( 'p.html' , 500 , 400 ) ; ", "openPopWin('p.html',500,400,'',30,40);", "openPopWin('p.html', 010, 5)",
+	"openPopImg('a.jpg','Neg',-3,300.5)", "openPopImg()", "openPopImg('a.jpg',1,)", "openPopImg('a.jpg');void(0)",
+	"window.openPopImg('a.jpg')", "openPopImg('a.jpg',\n1)", "openPopImg('What? Really?',1)", "openPopImg(0, 123456789012345)",
+	"openPopImg(9007199254740993)", "openPopImg('a' 'b')", "openPopImg('a,b', \"c,d\")", "openPopImg(,)",
+]
+
+def check_args(files):
+	# Prove that the openPop* fast path agrees with esprima on every javascript:
+	# link that it accepts, and time the two per link.
+	links = list(args_samples)
+	for fn in files:
+		with open(fn, "rb") as f: soup = BeautifulSoup(f.read(), "html5lib")
+		for elem in soup.find_all("a", href=True):
+			if (js := link_js(elem["href"])) is not None: links.append(js)
+	fast = [js for js in links if simple_popup.fullmatch(js)]
+	print("%d of %d links take the fast path" % (len(fast), len(links)))
+	if not fast: return
+	for label, extract in ("Esprima", esprima_popup_args), ("Fast path", simple_popup_args):
+		start = time.perf_counter()
+		for js in fast: extract(js)
+		print("%s: %.1fus per link" % (label, (time.perf_counter() - start) / len(fast) * 1000000))
+	wrong = 0
+	for js in fast:
+		try: expected = esprima_popup_args(js)
+		except Exception as e: expected = e
+		if expected != simple_popup_args(js):
+			print("MISMATCH", repr(js), expected, simple_popup_args(js))
+			wrong += 1
+	print("%d mismatches" % wrong)
+
+# --check-args [file...] compares the openPop* argument extractors (see above)
+# on the given files, or on the whole site, and changes nothing.
+if sys.argv[1:2] == ["--check-args"]:
+	check_args(sys.argv[2:] or html_files())
+	sys.exit(0)
+
 unique_scripts = open("popgoes.log", "w")
 scripts_seen = collections.Counter()
 
+# Every script group ever seen, and the files it was in as of the last time each
+# file was scanned; query it with popscripts.py. popgoes.log only gets the groups
+# that are new to this store, so it doesn't repeat itself run after run.
+db = sqlite3.connect("popgoes.db")
+db.execute("create table if not exists scripts (hash text primary key, body text)")
+db.execute("create table if not exists script_files (hash text, fn text, primary key (hash, fn))")
+db.execute("create index if not exists script_files_by_fn on script_files (fn)")
+stored_scripts = {hash for hash, in db.execute("select hash from scripts")}
+scanned = set()
+
 stats = collections.Counter()
 hovers = collections.Counter()
 comments = collections.Counter()
+counters = {"stats": stats, "hovers": hovers, "comments": comments, "scripts_seen": scripts_seen,
+	"js_cache_stats": js_cache_stats}
+
+# Pool workers (see -j below) don't print or log anything themselves, as only the
+# parent can tell what's new to the whole run. Instead, they hand back their
+# counter increments along with anything that might need reporting.
+worker = False
+handback = {"notes": [], "scripts": [], "js": []}
+
+def report(counter, key, *msg):
+	"""Print a message, or if a counter is named, only if key is new to it"""
+	if counter and key in counters[counter]: return
+	if worker: handback["notes"].append((counter, key, msg))
+	else: print(*msg)
+
+def store_script(hash, fn, script):
+	db.execute("insert into scripts values (?, ?)", (hash, script))
+	stored_scripts.add(hash)
+	print("=== %s === %s" % (hash, fn), file=unique_scripts)
+	print(script, file=unique_scripts)
+	print("=== ===\n", file=unique_scripts)
 
-def check_hover(elem, *attrs):
+def record_scripts(fn, hashes):
+	fn = os.path.abspath(fn)
+	db.execute("delete from script_files where fn = ?", (fn,))
+	db.executemany("insert into script_files values (?, ?)", [(hash, fn) for hash in hashes])
+	scanned.add(fn)
+	if not len(scanned) % 1000: db.commit()
+
+def check_hover(fn, elem, *attrs):
 	ret = False
 	for attr in attrs:
 		if attr not in elem.attrs: continue
 		info = classify_hover(elem, elem[attr])
 		if info["type"] == "Unknown":
-			print("Unknown JS:", fn, elem[attr])
-		elif info["type"] not in hovers:
-			print("JS:", info["type"], fn)
+			report(None, None, "Unknown JS:", fn, elem[attr])
+		else:
+			report("hovers", info["type"], "JS:", info["type"], fn)
 		hovers[info["type"]] += 1
 		if info["type"][0] == "*":
 			# Unnecessary JavaScript - take it out.
@@ -153,7 +311,7 @@ def classify(fn):
 	with open(fn, "rb") as f: blob = f.read()
 	soup = BeautifulSoup(blob, "html5lib")
 	changed = need_gsa_script = False
-	if soup.body and check_hover(soup.body, "onload", "onunload"): changed = True
+	if soup.body and check_hover(fn, soup.body, "onload", "onunload"): changed = True
 	for elem in soup.find_all("a", href=True):
 		with ExceptionContext("Element", elem):
 			if not elem.contents and not elem.text:
@@ -172,17 +330,11 @@ def classify(fn):
 				make_popup(elem)
 				changed = need_gsa_script = True
 				continue
-			p = urlparse(elem["href"])
-			if p.scheme.lower() == "javascript":
-				# When a question mark appears in the JS, browsers actually interpret it
-				# as the beginning of query parameters, as the apostrophe does not quote
-				# it. For our purposes, though, it's cleaner to simply rejoin that.
-				js = p.path
-				if p.query: js += "?" + p.query
+			js = link_js(elem["href"])
+			if js is not None:
 				info = classify_link(elem, js)
 				ty = info["type"]
-				if ty not in stats:
-					print(ty, fn)
+				report("stats", ty, ty, fn)
 				if ty == "openPopImg" or ty == "openPopWin":
 					# Rewrite this link as a class=popup
 					changed = need_gsa_script = True
@@ -196,11 +348,12 @@ def classify(fn):
 					if args: elem["data-height"], *args = args
 					make_popup(elem)
 				stats[ty] += 1
-			if check_hover(elem, "onclick", "onmouseover", "onmouseout"): changed = True
+			if check_hover(fn, elem, "onclick", "onmouseover", "onmouseout"): changed = True
 			if "class" in elem.attrs and elem["class"] in ("", "off", "on"):
 				del elem["class"]
 				changed = True
 	have_gsa_script = False
+	hashes = set()
 	for elem in soup.find_all("script"):
 		if elem.get("src") == "/gsarchive.js":
 			have_gsa_script = True
@@ -220,11 +373,11 @@ def classify(fn):
 			changed = True
 			script = "removed" # Log the script group as a single unit
 		hash = kwd + "-" + hashlib.sha1(script.encode()).hexdigest()
-		if hash not in scripts_seen:
-			print("=== %s === %s" % (hash, fn), file=unique_scripts)
-			print(script, file=unique_scripts)
-			print("=== ===\n", file=unique_scripts)
+		if hash not in scripts_seen and hash not in stored_scripts:
+			if worker: handback["scripts"].append((hash, fn, script))
+			else: store_script(hash, fn, script)
 		scripts_seen[hash] += 1
+		hashes.add(hash)
 	for elem in soup.find_all("link", {"rel": "stylesheet", "href": True}):
 		if "lightbox" in elem["href"]:
 			elem.replace_with("")
@@ -246,21 +399,77 @@ def classify(fn):
 		data = soup.encode(formatter="html5")
 		with open(fn, "wb") as f: f.write(data)
 		stats["Changed"] += 1
+	return hashes
+
+def become_worker():
+	global worker
+	worker = True
+
+def classify_file(fn):
+	# In a pool worker: classify one file, and hand back what that added to each
+	# counter (they only ever go up, so a before-and-after difference will do).
+	js_cache_stats["Memory"] = classify_js.cache_info().hits
+	before = {name: counter.copy() for name, counter in counters.items()}
+	try:
+		with ExceptionContext("File name", fn): hashes = classify(fn)
+	except Exception as e:
+		# The exception goes back to the parent by pickling, which the context (a
+		# Tag, say) mightn't survive, so flatten it to text.
+		e.context = {lbl: str(ctx) for lbl, ctx in getattr(e, "context", { }).items()}
+		raise
+	js_cache_stats["Memory"] = classify_js.cache_info().hits
+	deltas = {name: counter - before[name] for name, counter in counters.items()}
+	ret = fn, hashes, deltas, {key: items[:] for key, items in handback.items()}
+	for items in handback.values(): items.clear()
+	return ret
 
+def merge(deltas, handback):
+	# Notes and scripts have to be checked against the counters before this
+	# file's own increments go into them.
+	for counter, key, msg in handback["notes"]:
+		if not counter or key not in counters[counter]: print(*msg)
+	for hash, fn, script in handback["scripts"]:
+		if hash not in stored_scripts: store_script(hash, fn, script)
+	for kind, js, info in handback["js"]:
+		js_disk_cache[kind][js] = info
+	for name, delta in deltas.items(): counters[name].update(delta)
+
+# With -jN, files get classified (and fixed) in N worker processes; -j alone
+# uses one per CPU. All the reporting and logging still happens here.
+workers = 0
 for fn in sys.argv[1:]:
+	if fn.startswith("-j"):
+		workers = int(fn[2:] or os.cpu_count())
+		continue
 	if os.path.exists(fn):
-		with ExceptionContext("File name", fn): classify(fn)
+		with ExceptionContext("File name", fn): record_scripts(fn, classify(fn))
 		break
 else:
-	for root, dirs, files in os.walk(root):
-		if "backups" in dirs: dirs.remove("backups")
-		for file in files:
-			if not file.endswith(".html") and not file.endswith(".htm"): continue
-			fn = os.path.join(root, file)
+	if workers:
+		# Anything still buffered would otherwise get written out again by the workers.
+		sys.stdout.flush(); unique_scripts.flush()
+		# Forked, not spawned, as a spawned worker would rerun this whole script.
+		with multiprocessing.get_context("fork").Pool(workers, initializer=become_worker) as pool:
+			for fn, hashes, deltas, handback in pool.imap_unordered(classify_file, html_files(), chunksize=8):
+				merge(deltas, handback)
+				record_scripts(fn, hashes)
+	else:
+		for fn in html_files():
 			with ExceptionContext("File name", fn):
-				classify(fn)
+				record_scripts(fn, classify(fn))
+	# After a full scan, anything under root that wasn't seen is gone from the site.
+	base = os.path.join(os.path.abspath(root), "")
+	for fn, in db.execute("select distinct fn from script_files").fetchall():
+		if fn.startswith(base) and fn not in scanned: db.execute("delete from script_files where fn = ?", (fn,))
+db.commit()
 print(stats.total(), stats)
 print(hovers.total(), hovers)
+# The workers' hits were merged in above; a serial run's are all here.
+js_cache_stats["Memory"] += classify_js.cache_info().hits
+print(js_cache_stats.total(), "JS lookups:", js_cache_stats)
+if JS_CACHE_FILE:
+	with open(JS_CACHE_FILE, "w") as f:
+		json.dump({"source": js_source_stamp, "results": js_disk_cache}, f)
 print(scripts_seen.total(), scripts_seen)
 # Show all comments that get featured more than once; group the rest into "Other"
 #for c in list(comments):
@@ -0,0 +1,39 @@
+# Query the script store saved by popgoes.py
+# python3 popscripts.py - list every script group and how many files have it
+# python3 popscripts.py hash [hash...] - which files have these script groups?
+# python3 popscripts.py --in /path/to/file.html - what script groups are in this file?
+# python3 popscripts.py --show hash - print a script group's body
+# Hashes are as in popgoes.log (kwd-sha1), and any unambiguous prefix will do.
+import sqlite3
+import sys
+import os
+
+db = sqlite3.connect("popgoes.db")
+
+def find_hash(prefix):
+	hashes = [hash for hash, in db.execute("select hash from scripts where hash glob ? || '*'", (prefix,))]
+	if len(hashes) != 1:
+		print("%s: %s" % (prefix, "ambiguous" if hashes else "not found"), file=sys.stderr)
+		return None
+	return hashes[0]
+
+args = sys.argv[1:]
+if not args:
+	for hash, count in db.execute("""select hash, count(fn) from scripts left join script_files using (hash)
+			group by hash order by hash"""):
+		print(hash, count, sep="\t")
+elif args[0] == "--in":
+	for fn in args[1:]:
+		fn = os.path.abspath(fn)
+		for hash, in db.execute("select hash from script_files where fn = ? order by hash", (fn,)):
+			print(fn, hash, sep="\t")
+elif args[0] == "--show":
+	for arg in args[1:]:
+		if hash := find_hash(arg):
+			print("=== %s ===" % hash)
+			print(db.execute("select body from scripts where hash = ?", (hash,)).fetchone()[0])
+else:
+	for arg in args:
+		if hash := find_hash(arg):
+			for fn, in db.execute("select fn from script_files where hash = ? order by fn", (hash,)):
+				print(hash, fn, sep="\t")
@@ -14,9 +14,10 @@ import os
 import pprint
 import sys
 import re
+import time
 import hashlib
 import collections
-from bs4 import BeautifulSoup, Comment
+from bs4 import BeautifulSoup, Comment, Tag
 from urllib.parse import urlparse, urljoin, unquote, ParseResult
 
 # root = "/home/rosuav/gsarchive/live"
@@ -41,8 +42,6 @@ def report_with_context(t, v, c):
 	_old_excepthook(t, v, c)
 sys.excepthook = report_with_context
 
-logfile = open("tables.log", "w")
-changes = open("change.log", "w")
 def report(*msg):
 	print(json.dumps(msg), file=logfile)
 	print(*msg)
@@ -63,6 +62,55 @@ def next_element_sibling(basis):
 def get_child_nodes(node):
 	return [child for child in node.children if not isinstance(child, str) or child.strip()]
 
+# Index the structure of every table in the document, in one walk over the tree,
+# rather than searching each table and then checking what its findings belong to.
+# Gives each table its own rows (not those of tables nested in it), the cells
+# directly in each row, its caption, how many cells each row has, and how many
+# tables it's nested inside. Tags hash by their serialization, so it's keyed by
+# id(table), and it's in document order, like soup.find_all("table").
+def index_tables(soup):
+	tables = { }
+	pending = [(soup, ())] # Each node, and the tables it's inside
+	while pending:
+		node, enclosing = pending.pop()
+		if node.name == "table":
+			tables[id(node)] = {"table": node, "rows": [], "cells": [], "depth": len(enclosing)}
+			enclosing += (node,)
+		elif node.name == "tr" and enclosing:
+			layout = tables[id(enclosing[-1])]
+			layout["rows"].append(node)
+			# Note that this ignores colspan/rowspan
+			layout["cells"].append([cell for cell in node.children if cell.name in ("td", "th")])
+		elif node.name == "caption":
+			# Does the table contain a caption? If one exists, it is supposed to be
+			# the first child of the <table> element itself, but we're being a bit
+			# more flexible, and taking the first caption anywhere in the table, so
+			# long as it isn't a child of an inner table.
+			for table in enclosing:
+				tables[id(table)].setdefault("caption", node if table is enclosing[-1] else None)
+		pending.extend((child, enclosing) for child in reversed(node.contents) if isinstance(child, Tag))
+	for layout in tables.values():
+		layout.setdefault("caption", None)
+		layout["signature"] = [len(cells) for cells in layout["cells"]]
+	return tables
+
+# Serializing a table means serializing everything in it, and a big outer table
+# can get asked about more than once (for the marker images, and whether it's the
+# largest table on the page), so each table gets serialized at most once and the
+# features kept in its index entry. Anything that edits the tree has to call
+# tables_edited() first, while the node being edited is still where it was, so
+# that it and every table around it get measured afresh.
+MARKERS = ("/left.gif", "/right.gif", "/corner_1_trans.gif")
+def table_features(layout):
+	if "features" not in layout:
+		html = str(layout["table"])
+		layout["features"] = {"length": len(html)} | {marker: marker in html for marker in MARKERS}
+	return layout["features"]
+
+def tables_edited(tables, node):
+	if node.name == "table": tables[id(node)].pop("features", None)
+	for table in node.find_parents("table"): tables[id(table)].pop("features", None)
+
 def classify(fn):
 	info = { }
 	with open(fn, "rb") as f: blob = f.read()
@@ -71,7 +119,7 @@ def classify(fn):
 	# When we're done, the left/right corner GIFs shouldn't ever be needed. Note that
 	# this is pre-edit stats, so if any files are edited in this pass, they may show
 	# spuriously here.
-	if "/left.gif" in str(blob) or "/right.gif" in str(blob):
+	if b"/left.gif" in blob or b"/right.gif" in blob:
 		if soup.main:
 			# This normally shouldn't happen; it implies that a page has been edited,
 			# but still makes use of one of the corner GIFs.
@@ -80,27 +128,16 @@ def classify(fn):
 		else:
 			#report(fn, "No main, left/right GIF used")
 			stats["No main, left/right GIF used"] += 1
-	for table in soup.find_all("table"):
+	tables = index_tables(soup)
+	for layout in tables.values():
+		table = layout["table"]
 		with ExceptionContext("Table", table):
-			rows = []
-			for tr in table.find_all("tr"):
-				tb = tr.find_parent("table")
-				if tb is not table: continue # Probably nested tables
-				# Attempt to count the cells in this row by assuming that they are
-				# its immediate children, and are TDs and/or THs.
-				cells = list(tr.find_all("td", recursive=False)) + list(tr.find_all("th", recursive=False))
-				# Note that this ignores colspan/rowspan
-				rows.append(len(cells))
-				if len(cells) == 1:
-					data = cells[0]
-			# Does the table contain a caption? If one exists, it is supposed to be
-			# the first child of the <table> element itself, but we're being a bit
-			# more flexible, and just making sure it isn't a child of an inner table.
-			caption = table.caption
-			if caption and caption.find_parent("table") is not table: caption = None
+			rows = layout["signature"]
+			caption = layout["caption"]
 			# So, what's worth reporting?
 			# A table containing a single row with a single cell in it is notable.
 			if rows == [1]:
+				data = layout["cells"][0][0]
 				# Particularly if it has a caption, implying that it is really a figure in disguise.
 				if caption:
 					changed = need_gsa_css = True
@@ -158,6 +195,7 @@ def classify(fn):
 							figure["style"] = sty
 							stats["FiguresWidth"] += 1
 					# What was in the table cell now goes in the div; caption is still caption.
+					tables_edited(tables, table)
 					figure.div.extend(data)
 					figure.figcaption.extend(caption)
 					# Perfect. Let's swap that in!
@@ -179,6 +217,7 @@ def classify(fn):
 							div = soup.new_tag("div")
 							div["class"] = "masthead"
 							div.append("Gilbert and Sullivan Archive")
+							tables_edited(tables, table)
 							table.replace_with(div)
 							changed = need_gsa_css = True
 						elif "Gilbert and Sullivan Archive" in data.text:
@@ -189,6 +228,7 @@ def classify(fn):
 							report(fn, "Image masthead")
 							div = soup.new_tag("div")
 							div["class"] = "masthead image"
+							tables_edited(tables, table)
 							div.append(childnodes[0])
 							table.replace_with(div)
 							changed = need_gsa_css = True
@@ -217,6 +257,7 @@ def classify(fn):
 						if bg := table.get("bgcolor", data.get("bgcolor")):
 							styles.append("background-color: " + bg)
 						if styles: div["style"] = "; ".join(styles)
+						tables_edited(tables, table)
 						div.extend(data)
 						table.replace_with(div)
 						changed = need_gsa_css = True
@@ -238,8 +279,7 @@ def classify(fn):
 				stats["3-1-5"] += 1
 				# report(fn, "3-1-5 table")
 				children = ""
-				for tr in table.tbody.children:
-					if tr.name != "tr": continue
+				for tr in layout["rows"]:
 					desc = []
 					for td in tr.children:
 						if isinstance(td, str) and td.strip() == "": continue
@@ -290,8 +330,7 @@ def classify(fn):
 						# Otherwise: It's an outset table with matching tables above/below.
 						# The third table should have one row containing three cells.
 						more_content = maybe_content = None
-						for tr in nextnext.tbody.children:
-							if tr.name != "tr": continue
+						for tr in tables[id(nextnext)]["rows"]:
 							if maybe_content:
 								# Sometimes there's an extra row with no content.
 								no_content = True
@@ -331,13 +370,19 @@ def classify(fn):
 						# The thanks page is like the landing page, and needs a manual "width: 100%" added.
 						# Other than that, it is just like a 3-1-5 table despite being inside another table.
 						if not fn.endswith("/thanks.html") and \
-								table is not max(soup.find_all("table"), key=lambda elem: len(str(elem))):
+								table is not max(soup.find_all("table"), key=lambda elem: table_features(tables[id(elem)])["length"]):
 							report(fn, "Ignoring not-largest table")
 							continue # Guard against editing ones we're not looking at
 						next = None
 					# Okay, we got what we need. Let's do this!
 					changed = need_gsa_css = True
-					if soup.footer: soup.footer.replace_with("") # We'll have a new footer inside main.
+					tables_edited(tables, table)
+					if next:
+						tables_edited(tables, next)
+						tables_edited(tables, nextnext)
+					if soup.footer:
+						tables_edited(tables, soup.footer)
+						soup.footer.replace_with("") # We'll have a new footer inside main.
 					main = soup.new_tag("main")
 					if next:
 						# Merge in the other two tables; also, since this should be narrowed,
@@ -365,10 +410,11 @@ def classify(fn):
 					table.replace_with(main)
 					report(fn, "Replaced table with main")
 			else:
-				if "/left.gif" in str(table) or "/right.gif" in str(table):
+				features = table_features(layout)
+				if features["/left.gif"] or features["/right.gif"]:
 					report(fn, "Left/Right:" + "-".join(str(r) for r in rows))
 					stats["Left/Right:" + "-".join(str(r) for r in rows)] += 1
-				if "/corner_1_trans.gif" in str(table):
+				if features["/corner_1_trans.gif"]:
 					report(fn, "Transparent corner:" + "-".join(str(r) for r in rows))
 					stats["Transparent corner:" + "-".join(str(r) for r in rows)] += 1
 	if changed:
@@ -379,17 +425,52 @@ def classify(fn):
 		stats["Changed"] += 1
 		print(fn, file=changes)
 
+def html_files():
+	for base, dirs, files in os.walk(root):
+		if "backups" in dirs: dirs.remove("backups")
+		for file in files:
+			if not file.endswith(".html") and not file.endswith(".htm"): continue
+			yield os.path.join(base, file)
+
+def bench(files):
+	# Time the serialization that classify() needs for each page, the old way (every
+	# marker check and every largest-table search serializing afresh) and with the
+	# feature cache. Nothing gets changed.
+	totals = [0, 0]
+	for fn in files:
+		with open(fn, "rb") as f: soup = BeautifulSoup(f.read(), "html5lib")
+		tables = index_tables(soup)
+		searches = sum(layout["signature"] in ([3, 1, 5], [3, 5]) for layout in tables.values())
+		others = [layout for layout in tables.values() if layout["signature"] not in ([1], [3, 1, 5], [3, 5]) and not layout["caption"]]
+		start = time.perf_counter()
+		for layout in others:
+			for marker in MARKERS: marker in str(layout["table"])
+		for _ in range(searches): max(soup.find_all("table"), key=lambda elem: len(str(elem)))
+		uncached = time.perf_counter() - start
+		start = time.perf_counter()
+		for layout in others: table_features(layout)
+		for _ in range(searches): max(soup.find_all("table"), key=lambda elem: table_features(tables[id(elem)])["length"])
+		cached = time.perf_counter() - start
+		print("%s: %d tables, %.1fms uncached, %.1fms cached" % (fn, len(tables), uncached * 1000, cached * 1000))
+		totals[0] += uncached; totals[1] += cached
+	print("Total: %.1fms uncached, %.1fms cached" % (totals[0] * 1000, totals[1] * 1000))
+
+# --bench [file...] times the table serialization (see above) on the given files,
+# or on the largest pages on the site, and changes nothing.
+BENCH_PAGES = 25
+if sys.argv[1:2] == ["--bench"]:
+	bench(sys.argv[2:] or sorted(html_files(), key=os.path.getsize, reverse=True)[:BENCH_PAGES])
+	sys.exit(0)
+
+logfile = open("tables.log", "w")
+changes = open("change.log", "w")
 for fn in sys.argv[1:]:
 	if os.path.exists(fn):
 		with ExceptionContext("File name", fn): classify(fn)
 		break
 else:
-	for base, dirs, files in os.walk(root):
-		if "backups" in dirs: dirs.remove("backups")
-		for file in files:
-			if not file.endswith(".html") and not file.endswith(".htm"): continue
-			fn = os.path.join(base, file)
-			with ExceptionContext("File name", fn):
-				classify(fn)
+	for fn in html_files():
+		with ExceptionContext("File name", fn):
+			classify(fn)
 
 pprint.pprint(stats)
@@ -22,11 +22,49 @@
 import json
 import os
 import re
+import sys
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import functools
 import collections
+import concurrent.futures
+import multiprocessing
 from urllib.parse import urlparse, urljoin, unquote, ParseResult
+from html.parser import HTMLParser
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import UnicodeDammit
 root = "/home/rosuav/gsarchive/live"
 
+# With -jN, pages are parsed in N worker processes (-j alone uses one per CPU).
+# The workers only extract links; all bookkeeping and logging stays here.
+# Pages that haven't changed since the last run reuse the links found then,
+# unless --full is given to force everything to be parsed again.
+# Links (including CSS url() references) are found with a plain tokenizer;
+# --verify also parses every page with BeautifulSoup, reports any page where
+# the two disagree, and goes with the soup.
+# --bench [page...] times both on the same pages and exits without crawling.
+# --resume carries on from the last checkpoint of an interrupted crawl.
+workers = 0
+full = verify = bench = resume = False
+bench_pages = []
+for arg in sys.argv[1:]:
+	if arg == "-j" or arg.startswith("-j") and arg[2:].isdigit(): workers = int(arg[2:] or os.cpu_count())
+	elif arg == "--full": full = True
+	elif arg == "--verify": verify = True
+	elif arg == "--bench": bench = True
+	elif arg == "--resume": resume = True
+	elif bench and not arg.startswith("-"): bench_pages.append(arg)
+	else:
+		# Don't guess. A mistyped --resume would otherwise start a fresh crawl, which
+		# throws away the very checkpoint it was meant to resume from.
+		print("Unrecognized argument:", arg, file=sys.stderr)
+		print("USAGE: python3 weakest_link.py [-jN] [--full] [--verify] [--resume] [--bench [page...]]", file=sys.stderr)
+		sys.exit(1)
+
 scanned = { }
 unscanned = set()
 awaiting = []
@@ -35,25 +73,63 @@ config = { }
 try:
 	with open("weakest_link.json") as f: config = json.load(f)
 except FileNotFoundError: pass
-for ensure in "redirects", "use_https", "known_links": # Match weakest_link_checker
+for ensure in "redirects", "use_https", "known_links", "probed", "dead_hosts": # Match weakest_link_checker
 	if ensure not in config: config[ensure] = { }
+# Build this file on the server for performance
+# find -type f -printf '%P\t%s\n'|grep -v '^backups/' >backups/all_files.txt
+# It's used for existence checks and sizes, since the live tree is on a network
+# mount and every stat is a round trip. A manifest with only the file names (as
+# from "find -type f|cut -c3-") still works, but sizes then cost a stat each.
+# A manifest older than this is only used to list files, not to answer lookups.
+MANIFEST_MAX_AGE = 86400
+manifest = { } # "/path/to/file": size, or None if not listed
+manifest_dirs = set()
+manifest_casefold = collections.defaultdict(list)
+fresh_manifest = False
 try:
-	# Build this file on the server for performance
-	# find -type f|cut -c3-|grep -v '^backups/' >backups/all_files.txt
 	with open(root + "/backups/all_files.txt") as f:
-		unscanned = {"/" + line.strip() for line in f}
-except FileNotFoundError: pass
+		for line in f:
+			name, *size = line.strip().split("\t")
+			fn = "/" + name
+			manifest[fn] = int(size[0]) if size else None
+			manifest_casefold[fn.casefold()].append(fn)
+			dir = fn.rpartition("/")[0]
+			while dir and dir not in manifest_dirs:
+				manifest_dirs.add(dir)
+				dir = dir.rpartition("/")[0]
+		fresh_manifest = time.time() - os.fstat(f.fileno()).st_mtime < MANIFEST_MAX_AGE
+	if not fresh_manifest: print("File manifest is stale, checking the filesystem directly")
+except FileNotFoundError: print("No file manifest, checking the filesystem directly")
+unscanned = set(manifest)
 unscanned_count = len(unscanned) # Progress is achieved by shrinking the set
-# Links to these borked files are potentially a problem. Trace them.
-borked = {
-	"/html/perf_grps/websites/gb/index.html",
-	"/carte/index.html",
-	"/html/raywalker/faqs.html",
-	"/html/shop_files/faqs.html",
-}
-files_by_content = collections.defaultdict(list)
-
-logfile = open("weakest_link.log", "w")
+# Referenced files, grouped by size. Only when an unscanned file has the same size
+# as some of these do we need to look at contents to spot duplicates.
+files_by_size = collections.defaultdict(list)
+file_digests = { }
+# The link graph from previous runs: every page parsed, with its mtime and size
+# at the time, and the links that were on it (as returned by extract_links).
+db = sqlite3.connect("weakest_link.db")
+db.execute("create table if not exists pages (fn text primary key, mtime real, size integer, links text)")
+# Bump this whenever extract_links() changes what it finds, so that links stored
+# by an older version get thrown away rather than reused.
+LINK_FORMAT = 1
+if db.execute("pragma user_version").fetchone()[0] != LINK_FORMAT:
+	db.execute("delete from pages")
+	db.execute("pragma user_version = %d" % LINK_FORMAT)
+	db.commit()
+page_stamps = { }
+# Every so often, the state of the crawl gets saved, in the same transaction as
+# the links stored since the last checkpoint. Anything after that (including
+# whatever was logged) is redone on resumption.
+CHECKPOINT_INTERVAL = 60 # seconds
+db.execute("create table if not exists checkpoint (state blob)")
+# Every link found, from the page (or stylesheet) it's on to the file or URL it
+# points to. Rebuilt by each crawl; see backlinks.py to query it.
+db.execute("create table if not exists links (source text, target text, attr text)")
+db.execute("create index if not exists links_by_source on links (source)")
+db.execute("create index if not exists links_by_target on links (target)")
+last_checkpoint = time.monotonic()
+
 def report(*msg):
 	print(json.dumps(msg), file=logfile)
 	print(*msg)
@@ -66,14 +142,33 @@ def report_once(key, *msg):
 def fix(oldurl, newurl, context):
 	report("AUTOFIX", context, oldurl, newurl)
 
+def dir_index(path):
+	# Directory names get handled by index files
+	return path + "index.html" # Is this the only name available? If multiple, what priority order?
+
 def path_from_fn(fn):
 	path = root + unquote(fn)
-	if path.endswith("/"):
-		# Directory names get handled by index files
-		path += "index.html" # Is this the only name available? If multiple, what priority order?
+	if path.endswith("/"): path = dir_index(path)
 	return path
 
-def link(context, url, *, base="https://gsarchive.net/"):
+def file_size(fn):
+	# The size of the file that fn refers to, or None if it doesn't exist.
+	path = unquote(fn)
+	if path.endswith("/"): path = dir_index(path)
+	if fresh_manifest and path not in manifest_dirs:
+		if path not in manifest: return None
+		if manifest[path] is not None: return manifest[path]
+	try: return os.stat(root + path).st_size
+	except OSError: return None
+
+def find_casefold(fn):
+	# Look for a file that differs from fn only in letter case
+	path = unquote(fn)
+	if path.endswith("/"): path = dir_index(path)
+	for match in manifest_casefold.get(path.casefold(), ()):
+		if match != path: return match
+
+def link(context, url, attr=None, *, base="https://gsarchive.net/"):
 	# Make the URL absolute
 	uri = urljoin(urljoin(base, context), url)
 	fn = None
@@ -126,59 +221,297 @@ def link(context, url, *, base="https://gsarchive.net/"):
 			report("Non-HTTP link", context, url)
 		case _:
 			report("Unparseable link", context, url)
+	if attr: db.execute("insert into links values (?, ?, ?)", (context, fn or uri, attr))
 	if not fn: return
-	# There are a handful of borked files that I need to back-trace.
-	if fn in borked: report("Link to borked file", context, url)
 	if fn in scanned: return
-	scanned[fn] = 1
+	scanned[fn] = context, url # Where it was first found, in case it's gone by the time it's read
 	unscanned.discard(fn)
-	if not os.path.exists(path_from_fn(fn)):
-		report("Internal link not found", context, url, fn)
+	size = file_size(fn)
+	if size is None:
+		# If it's just the wrong letter case, say so, to save having to go looking.
+		if case := find_casefold(fn): report("Internal link not found", context, url, fn, case)
+		else: report("Internal link not found", context, url, fn)
 		return
-	# Attempt to recognize duplicate files. Note that we could stat before
-	# opening, but that's probably extra round trips. Haven't tested though.
-	with open(path_from_fn(fn), "rb") as f:
-		size = f.seek(0, 2)
-		f.seek(0)
-		if size <= 1048576:
-			files_by_content[f.read()].append(fn)
+	files_by_size[size].append(fn)
 	base, dot, ext = fn.rpartition(".")
-	if not dot or ext in ("html", "htm"):
+	if not dot or ext in ("html", "htm", "css"):
 		awaiting.append(fn)
-	# Anything else we should be checking? Scan CSS files for references, maybe?
 
-def find_links(fn):
-	with open(path_from_fn(fn), "rb") as f:
-		soup = BeautifulSoup(f.read(), "html.parser")
+def digest(fn):
+	# Fingerprint a file's contents, reading it in chunks so that memory usage
+	# stays flat no matter how big the file is. None if the file has vanished.
+	if fn not in file_digests:
+		h = hashlib.sha256()
+		try:
+			with open(path_from_fn(fn), "rb") as f:
+				while chunk := f.read(1048576): h.update(chunk)
+		except FileNotFoundError: file_digests[fn] = None
+		else: file_digests[fn] = h.digest()
+	return file_digests[fn]
+
+# Stylesheets reference images etc with url(...) and other sheets with @import.
+# Quoted or not, but never mind the escapes, nobody uses them.
+css_reference = re.compile(r"""
+	url\(\s*(?:"([^"]*)"|'([^']*)'|([^"')\s]*))\s*\)
+	| @import\s*(?:"([^"]*)"|'([^']*)')
+""", re.IGNORECASE | re.VERBOSE)
+css_comment = re.compile(r"/\*.*?\*/", re.DOTALL)
+
+@functools.lru_cache(maxsize=4096) # The same inline styles turn up over and over
+def css_urls(css):
+	urls = []
+	for m in css_reference.finditer(css_comment.sub("", css)):
+		url = "".join(m.groups(""))
+		if url and not url.startswith("data:"): urls.append(url)
+	return tuple(urls)
+
+def links_from_css(blob):
+	return [("css", "url", url, False) for url in css_urls(UnicodeDammit(blob).unicode_markup)]
+
+class LinkExtractor(HTMLParser):
+	# Produces the same links as links_from_soup() below, straight from the token
+	# stream. The only structure tracked is the stack of open elements, so that
+	# an <a> can be seen to be empty once it has been closed.
+	def __init__(self):
+		super().__init__()
+		self.links = []
+		self.open = [] # [tag, attrs, is_empty] for each element not yet closed
+		self.style = [] # Text of the current <style> block
+
+	def add_links(self, tag, attrs, empty):
+		for attr in "src", "href", "background":
+			if attr in attrs: self.links.append((tag, attr, attrs[attr], empty))
+		for url in css_urls(attrs.get("style", "")):
+			self.links.append((tag, "style", url, False))
+
+	def child(self):
+		# Anything at all inside an element (even whitespace) means it isn't empty
+		if self.open: self.open[-1][2] = False
+
+	def handle_starttag(self, tag, attrs, *, closed=False):
+		self.child()
+		# As per BeautifulSoup: valueless attributes are blank, and the last of any
+		# duplicated attribute wins. Void elements can't have content.
+		attrs = {attr: value or "" for attr, value in attrs}
+		if closed or tag in HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS: self.add_links(tag, attrs, tag == "a")
+		else: self.open.append([tag, attrs, True])
+
+	def handle_startendtag(self, tag, attrs):
+		self.handle_starttag(tag, attrs, closed=True)
+
+	def handle_endtag(self, tag):
+		# An end tag closes the most recent matching element and anything opened
+		# since; if nothing matches, it's ignored.
+		for i in reversed(range(len(self.open))):
+			if self.open[i][0] == tag:
+				self.close_elements(i)
+				break
+
+	def close_elements(self, start):
+		for tag, attrs, empty in reversed(self.open[start:]):
+			self.add_links(tag, attrs, tag == "a" and empty)
+			if tag == "style":
+				for url in css_urls("".join(self.style)):
+					self.links.append(("style", "url", url, False))
+				self.style = []
+		del self.open[start:]
+
+	def handle_data(self, data):
+		if self.open and self.open[-1][0] == "style": self.style.append(data)
+		self.child()
+	def handle_comment(self, data): self.child()
+	def handle_decl(self, decl): self.child()
+	def handle_pi(self, data): self.child()
+	def unknown_decl(self, data): self.child()
+
+def links_from_html(blob):
+	parser = LinkExtractor()
+	parser.feed(UnicodeDammit(blob, is_html=True).unicode_markup)
+	parser.close()
+	parser.close_elements(0)
+	return parser.links
+
+def links_from_soup(blob):
+	soup = BeautifulSoup(blob, "html.parser")
+	links = []
 	for attr in "src", "href", "background":
 		for elem in soup.find_all(attrs={attr: True}):
-			if elem.name == "a" and not elem.text and not list(elem.children):
-				report("Empty anchor", fn, elem.get(attr))
-			link(fn, elem.get(attr))
+			empty = elem.name == "a" and not elem.text and not list(elem.children)
+			links.append((elem.name, attr, elem.get(attr), empty))
+	for elem in soup.find_all(style=True):
+		for url in css_urls(elem["style"]): links.append((elem.name, "style", url, False))
+	for elem in soup.find_all("style"):
+		for url in css_urls(elem.get_text()): links.append(("style", "url", url, False))
+	return links
+
+def extract_links(fn):
+	# Returns (tag, attr, value, is_empty_anchor) for every reference on the page,
+	# or None if the page has vanished (see vanished() below). No side effects, so
+	# this is what gets farmed out to the worker processes.
+	try:
+		with open(path_from_fn(fn), "rb") as f: blob = f.read()
+	except FileNotFoundError: return None
+	if fn.endswith(".css"): return links_from_css(blob)
+	links = links_from_html(blob)
+	if verify:
+		soup_links = links_from_soup(blob)
+		if sorted(links) != sorted(soup_links):
+			print("EXTRACTOR MISMATCH", fn)
+			print("Tokenizer only:", list((collections.Counter(links) - collections.Counter(soup_links)).elements()))
+			print("Soup only:", list((collections.Counter(soup_links) - collections.Counter(links)).elements()))
+		links = soup_links
+	return links
+
+def find_links(fn, links):
+	for tag, attr, value, empty in links:
+		if empty: report("Empty anchor", fn, value)
+		link(fn, value, attr)
+
+def vanished(fn):
+	# A fresh manifest is trusted to say what exists, but a page can still be
+	# deleted after it was built; the link to it is then as broken as any other.
+	page_stamps.pop(fn, None)
+	context, url = scanned[fn]
+	report("Internal link not found", context, url, fn)
 
-link("/", "/")
-while awaiting:
-	fn = awaiting.pop()
+def stored_links(fn):
+	# If the page is unchanged since it was last parsed, return the links we found
+	# then. Otherwise None, and whatever gets parsed next should be stored. No
+	# reporting happens here, as pages can be looked up ahead of their turn; if the
+	# page has vanished, extract_links() will find that out in its turn.
+	try: st = os.stat(path_from_fn(fn))
+	except FileNotFoundError: return None
+	page_stamps[fn] = st.st_mtime, st.st_size
+	if full: return None
+	row = db.execute("select mtime, size, links from pages where fn = ?", (fn,)).fetchone()
+	if row and (row[0], row[1]) == page_stamps[fn]: return json.loads(row[2])
+
+def store_links(fn, links):
+	db.execute("insert or replace into pages values (?, ?, ?, ?)", (fn, *page_stamps.pop(fn), json.dumps(links)))
+
+def checkpoint():
+	global last_checkpoint
+	logfile.flush()
+	state = {
+		"scanned": scanned, "awaiting": awaiting, "logged": logged,
+		"files_by_size": files_by_size, "log_offset": logfile.tell(),
+	}
+	db.execute("delete from checkpoint")
+	db.execute("insert into checkpoint values (?)", (zlib.compress(pickle.dumps(state)),))
+	db.commit()
+	last_checkpoint = time.monotonic()
+
+def maybe_checkpoint():
+	if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL: checkpoint()
+
+def progress(fn):
 	print("[%d%% scanned, %d queued]" % (100 - len(unscanned) * 100 // unscanned_count, len(awaiting)), fn, "...")
-	find_links(fn)
+
+if bench:
+	# Read everything up front, so that it's the parsing being timed and not the mount.
+	pages = bench_pages or sorted(fn for fn in unscanned if fn.endswith((".html", ".htm")))
+	blobs = []
+	for fn in pages:
+		with open(path_from_fn(fn), "rb") as f: blobs.append(f.read())
+	for label, extractor in ("Tokenizer", links_from_html), ("Soup", links_from_soup):
+		start = time.perf_counter()
+		for blob in blobs: extractor(blob)
+		elapsed = time.perf_counter() - start
+		print("%s: %d pages in %.2fs, %.1f pages/sec" % (label, len(blobs), elapsed, len(blobs) / elapsed))
+	sys.exit(0)
+
+if resume:
+	row = db.execute("select state from checkpoint").fetchone()
+	if not row:
+		print("No checkpoint to resume from")
+		sys.exit(1)
+	state = pickle.loads(zlib.decompress(row[0]))
+	scanned, awaiting, logged = state["scanned"], state["awaiting"], state["logged"]
+	files_by_size = state["files_by_size"]
+	# Drop anything logged since the checkpoint, as it's about to be logged again.
+	# If the log is shorter than that, it isn't the log this checkpoint was made
+	# with, and truncate() would pad it out with NULs rather than trimming it.
+	try: log_size = os.path.getsize("weakest_link.log")
+	except FileNotFoundError: log_size = -1
+	if log_size < state["log_offset"]:
+		print("weakest_link.log is missing or shorter than the checkpoint expects, can't resume")
+		sys.exit(1)
+	unscanned.difference_update(scanned)
+	logfile = open("weakest_link.log", "r+")
+	logfile.truncate(state["log_offset"])
+	logfile.seek(state["log_offset"])
+	print("Resuming with %d scanned, %d queued" % (len(scanned), len(awaiting)))
+else:
+	# A fresh crawl invalidates any checkpoint from an earlier one, since the log
+	# it refers to is about to be replaced.
+	db.execute("delete from checkpoint")
+	db.commit()
+	logfile = open("weakest_link.log", "w")
+	db.execute("delete from links")
+	link("/", "/")
+if workers:
+	# The pool must be forked, not spawned: a spawned worker would reimport this
+	# script and start a crawl of its own. Flush first so that nothing buffered
+	# gets duplicated into the children.
+	logfile.flush()
+	with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+		# Pages are still taken in exactly the order a serial crawl would take them,
+		# so that everything gets reported from the same place; the workers just get
+		# a head start on parsing what's nearest the top of the stack. None of that
+		# is wasted even if new links get pushed on top, as every queued page gets
+		# its turn sooner or later. Prefetched pages stay in awaiting until then, so
+		# a checkpoint needn't know about them.
+		prefetched = { } # fn: its stored links, or a future for the links being parsed
+		while awaiting:
+			for fn in awaiting[-workers * 4:]:
+				if fn not in prefetched:
+					links = stored_links(fn)
+					prefetched[fn] = pool.submit(extract_links, fn) if links is None else links
+			fn = awaiting.pop()
+			progress(fn)
+			links = prefetched.pop(fn)
+			if isinstance(links, concurrent.futures.Future):
+				links = links.result()
+				if links is None:
+					vanished(fn)
+					links = []
+				else: store_links(fn, links)
+			find_links(fn, links)
+			maybe_checkpoint()
+else:
+	while awaiting:
+		fn = awaiting.pop()
+		progress(fn)
+		links = stored_links(fn)
+		if links is None:
+			links = extract_links(fn)
+			if links is None:
+				vanished(fn)
+				links = []
+			else: store_links(fn, links)
+		find_links(fn, links)
+		maybe_checkpoint()
+checkpoint()
 
 # Any unscanned files get logged.
 for fn in sorted(unscanned):
 	# See if they're duplicates of files that ARE referenced.
-	try:
-		with open(path_from_fn(fn), "rb") as f:
-			size = f.seek(0, 2)
-			f.seek(0)
-			if size <= 1048576:
-				files = files_by_content[f.read()]
-				if len(files) == 1:
-					report("Unscanned duplicate file", "/", fn, files[0])
-					continue
-				elif files:
-					report("Unscanned replicant file", "/", fn, len(files))
-					continue
-	except FileNotFoundError:
-		continue # It's not an unscanned file if the file has been deleted
+	size = file_size(fn)
+	if size is None: continue # It's not an unscanned file if the file has been deleted
+	if size in files_by_size:
+		if (content := digest(fn)) is None: continue
+		files = [f for f in files_by_size[size] if digest(f) == content]
+		if len(files) == 1:
+			report("Unscanned duplicate file", "/", fn, files[0])
+			continue
+		elif files:
+			report("Unscanned replicant file", "/", fn, len(files))
+			continue
+	# The manifest may be answering for a file that has been deleted since.
+	if not os.path.exists(path_from_fn(fn)): continue
 	report("Unscanned file", "/", fn)
 
 print(len(unscanned), "out of", unscanned_count, "still unscanned")
+# All done, nothing to resume.
+db.execute("delete from checkpoint")
+db.commit()
@@ -2,13 +2,19 @@
 import json
 import re
 import os
+import sys
+import time
+import threading
+import collections
 import urllib.parse
+import concurrent.futures
 import requests
+import requests.adapters
 config = { }
 try:
 	with open("weakest_link.json") as f: config = json.load(f)
 except FileNotFoundError: pass
-for ensure in "redirects", "use_https", "known_links":
+for ensure in "redirects", "use_https", "known_links", "probed", "dead_hosts":
 	if ensure not in config: config[ensure] = { }
 
 root = "/home/rosuav/gsarchive/live"
@@ -20,23 +26,173 @@ def handler(n):
 		return f
 	return wrapper
 
+# External links aren't probed as they're found in the log, but all together at
+# the end, several at a time. Each host gets its own session (so connections get
+# reused) and is never sent more than PER_HOST_LIMIT requests at once; across all
+# hosts, no more than PROBE_RATE requests get started per second.
+PROBE_THREADS = 16
+PER_HOST_LIMIT = 2
+PROBE_RATE = 10
+to_probe = { } # Used as an ordered set
+sessions = { }
+host_slots = { }
+probe_lock = threading.Lock()
+next_probe = 0.0
+# Probing only ever needs the status line and headers, so bodies aren't fetched.
+# These count what did get transferred, and what was skipped by not downloading
+# the bodies (as far as the servers' Content-Length headers tell us).
+transfer = {"probes": 0, "bytes": 0, "skipped": 0}
+# Known links don't stay known forever. config["probed"] has, for each URL, when
+# it was last probed and the validators the server gave us then; once the entry is
+# older than this, the URL gets probed again, conditionally, so that anything
+# unchanged costs a 304. (Links known from before probe times were recorded
+# count as expired.)
+KNOWN_LINK_TTL = 30 * 86400
+# When a whole site has gone away, there's no point waiting out a connection
+# attempt for every link to it. Once a host has failed to resolve or connect this
+# many times in a row (counting previous runs), the rest of its links are marked
+# unreadable without being probed, until DEAD_HOST_TTL after the last failure.
+# These are tracked in config["dead_hosts"], which the probe threads share.
+DEAD_HOST_FAILURES = 2
+DEAD_HOST_TTL = 7 * 86400
+PROBE_TIMEOUT = 10, 30 # Connect, read
+
 @handler("External link")
 @handler("Non-encrypted link outside site")
 def extlink(type, context, url, extra):
 	# Add rules here for known patterns
 	# TODO: http://www.cris.com/~oakapple/gasdisc/ --> http://www.gasdisc.oakapplepress.com/
-	if url in config["known_links"]: return
+	if url in config["known_links"] and not expired(url): return
+	to_probe[url] = None
+
+def expired(url):
+	probed = config["probed"].get(url)
+	return not probed or time.time() - probed["time"] > KNOWN_LINK_TTL
+
+def validators(url):
+	# Conditional request headers, if this is a revalidation
+	if url not in config["known_links"]: return { }
+	probed = config["probed"].get(url, { })
+	headers = { }
+	if "etag" in probed: headers["If-None-Match"] = probed["etag"]
+	if "last_modified" in probed: headers["If-Modified-Since"] = probed["last_modified"]
+	return headers
+
+def host_session(netloc):
+	with probe_lock:
+		if netloc not in sessions:
+			sessions[netloc] = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PER_HOST_LIMIT)
+			sessions[netloc].mount("http://", adapter)
+			sessions[netloc].mount("https://", adapter)
+			host_slots[netloc] = threading.Semaphore(PER_HOST_LIMIT)
+		return sessions[netloc], host_slots[netloc]
+
+def rate_limit():
+	global next_probe
+	with probe_lock:
+		now = time.monotonic()
+		delay = next_probe - now
+		next_probe = max(now, next_probe) + 1 / PROBE_RATE
+	if delay > 0: time.sleep(delay)
+
+def host_is_dead(netloc):
+	with probe_lock:
+		dead = config["dead_hosts"].get(netloc)
+		if not dead: return False
+		if time.time() - dead["time"] > DEAD_HOST_TTL:
+			# Give it another chance
+			del config["dead_hosts"][netloc]
+			return False
+		return dead["failures"] >= DEAD_HOST_FAILURES
+
+def host_failed(netloc):
+	with probe_lock:
+		dead = config["dead_hosts"].setdefault(netloc, {"failures": 0})
+		dead["failures"] += 1
+		dead["time"] = time.time()
+
+def host_responded(netloc):
+	with probe_lock:
+		config["dead_hosts"].pop(netloc, None)
+
+def probe(url, headers):
+	# Runs in a worker thread, so apart from the dead hosts (under the lock) it
+	# mustn't touch the config. Returns the response, or None if the server
+	# couldn't be reached at all, and whether it was skipped without trying
+	# because the host is known to be down.
+	netloc = urllib.parse.urlparse(url).netloc
+	if host_is_dead(netloc): return None, True
+	session, slot = host_session(netloc)
+	with slot:
+		rate_limit()
+		# Other probes of this host may have given up on it while we waited for
+		# the slot or the rate limit.
+		if host_is_dead(netloc): return None, True
+		try:
+			r = session.head(url, headers=headers, allow_redirects=False, timeout=PROBE_TIMEOUT)
+			if r.status_code in (400, 403, 405, 501):
+				# Some servers don't do HEAD (or do it badly). Ask for the page, but
+				# hang up as soon as we have the headers.
+				r = session.get(url, headers=headers, allow_redirects=False, stream=True, timeout=PROBE_TIMEOUT)
+				r.close()
+		except requests.exceptions.ConnectionError:
+			# Includes DNS failures and connection timeouts
+			host_failed(netloc)
+			return None, False
+		except requests.exceptions.Timeout:
+			return None, False # Connected, but then no response, so the host isn't dead
+		host_responded(netloc)
+		return r, False
+
+def header_size(r):
+	# Roughly what came over the wire: the status line and headers, no body.
+	return len("HTTP/1.1 %d %s\r\n\r\n" % (r.status_code, r.reason)) + \
+		sum(len(k) + len(v) + 4 for k, v in r.headers.items())
+
+def body_length(r):
+	# What the server says the body would have been. Only used for reporting, so
+	# anything unexpected just counts as nothing. A header sent twice arrives
+	# folded together, eg "10, 10".
+	try: return max(int(r.headers.get("Content-Length", "").split(",")[0] or "0"), 0)
+	except ValueError: return 0
+
+def record_probe(url, r, skipped):
 	# Very very basic validation: if the server returns anything in the 200 range,
 	# it's fine. If anything in the 400 or 500 range, error.
-	print("Probing external link", url)
-	try:
-		r = requests.get(url, allow_redirects=False)
-	except requests.exceptions.ConnectionError:
+	if skipped: print("Skipped external link", url)
+	else: print("Probed external link", url)
+	parsed = urllib.parse.urlparse(url)
+	if skipped:
+		# Not actually probed, so it doesn't get a probe time: that would keep it
+		# from being looked at again for KNOWN_LINK_TTL, rather than for as long
+		# as the host stays on the dead list.
+		print("** Unreadable external link (host is down) **")
+		config["known_links"][url] = False
+		return
+	previous = config["probed"].get(url, { })
+	config["probed"][url] = probed = {"time": time.time()}
+	if r is None:
 		print("** Unreadable external link **")
 		config["known_links"][url] = False
 		return
+	if r.status_code == 304:
+		# A 304 needn't repeat the validators, so keep the ones we had.
+		for key in "etag", "last_modified":
+			if key in previous: probed[key] = previous[key]
+	for header, key in ("ETag", "etag"), ("Last-Modified", "last_modified"):
+		if header in r.headers: probed[key] = r.headers[header]
+	size = header_size(r)
+	body_size = body_length(r)
+	print("%s %d, %d bytes transferred, %d bytes of body skipped" % (r.request.method, r.status_code, size, body_size))
+	transfer["probes"] += 1
+	transfer["bytes"] += size
+	transfer["skipped"] += body_size
+	if r.status_code == 304:
+		# Revalidated. Whatever we knew about it before still stands.
+		print("Unchanged since last probe")
+		return
 	config["known_links"][url] = r.ok
-	parsed = urllib.parse.urlparse(url)
 	if parsed.scheme == "http":
 		dest = r.headers["Location"] if r.is_redirect else None
 		# If it sends us to the exact same URL but with https://,
@@ -57,7 +213,59 @@ def extlink(type, context, url, extra):
 		print("** Broken external link **")
 		print(r)
 
-soup_catcher = { }
+def probe_all(urls):
+	# The results are all recorded here in the main thread, as they come in.
+	pool = concurrent.futures.ThreadPoolExecutor(PROBE_THREADS)
+	try:
+		futures = {pool.submit(probe, url, validators(url)): url for url in urls}
+		for future in concurrent.futures.as_completed(futures):
+			record_probe(futures[future], *future.result())
+	finally:
+		# If we're halted, don't hang around for the rest of the queue.
+		pool.shutdown(cancel_futures=True)
+	if transfer["probes"]:
+		print("Probed %d links: %d bytes transferred, %d bytes of body skipped" % (
+			transfer["probes"], transfer["bytes"], transfer["skipped"]))
+
+# Parsed files, and how many fixes each has had since it was last written out.
+# Fixes are made to the soup in memory, and the file gets written once, at the
+# end, or when its soup is evicted to make room for others. The most recently used
+# SOUP_CACHE_SIZE soups are kept.
+SOUP_CACHE_SIZE = 250
+soup_catcher = collections.OrderedDict()
+soup_stats = collections.Counter()
+pending_fixes = collections.Counter()
+fixes_written = collections.Counter()
+
+def get_soup(context):
+	from bs4 import BeautifulSoup
+	if context in soup_catcher:
+		soup_stats["hits"] += 1
+		soup_catcher.move_to_end(context)
+		return soup_catcher[context]
+	soup_stats["misses"] += 1
+	with open(root + context, "rb") as f:
+		soup = soup_catcher[context] = BeautifulSoup(f.read(), "html.parser")
+	if len(soup_catcher) > SOUP_CACHE_SIZE:
+		soup_stats["evictions"] += 1
+		oldest = next(iter(soup_catcher))
+		write_back(oldest)
+		del soup_catcher[oldest]
+	return soup
+
+def write_back(context):
+	if not pending_fixes[context]: return
+	mangled = root + "/backups/" + context.replace("/", "_")
+	if not os.path.exists(mangled): os.rename(root + context, mangled)
+	with open(root + context, "wb") as f:
+		# Note: Using the HTML5 formatter with HTML4 Transitional documents (as many
+		# of these files are) may cause oddities. Ultimately, we should just move to
+		# all HTML5 files anyway, at which point it won't matter; in the meantime,
+		# there may be some quirks with odd attributes. This is why we have backups.
+		# (Anyway, the files seem to use HTML5 style booleans already, so it's not
+		# going to be any worse.)
+		f.write(soup_catcher[context].encode(formatter="html5"))
+	fixes_written[context] += pending_fixes.pop(context)
 
 @handler("AUTOFIX")
 def autofix(type, context, url, extra):
@@ -65,25 +273,80 @@ def autofix(type, context, url, extra):
 	# Go through the file, find all references to 'url', replace with extra[0].
 	print("FIX", context, url, extra[0])
 	if context.endswith("/"): return
-	mangled = root + "/backups/" + context.replace("/", "_")
-	from bs4 import BeautifulSoup
-	if mangled in soup_catcher:
-		soup = soup_catcher[mangled]
-	else:
-		with open(root + context, "rb") as f:
-			soup = soup_catcher[mangled] = BeautifulSoup(f.read(), "html.parser")
-		if not os.path.exists(mangled): os.rename(root + context, mangled)
+	soup = get_soup(context)
 	for attr in "src", "href", "background":
 		for elem in soup.find_all(attrs={attr: url}):
 			elem[attr] = extra[0]
-	with open(root + context, "wb") as f:
-		# Note: Using the HTML5 formatter with HTML4 Transitional documents (as many
-		# of these files are) may cause oddities. Ultimately, we should just move to
-		# all HTML5 files anyway, at which point it won't matter; in the meantime,
-		# there may be some quirks with odd attributes. This is why we have backups.
-		# (Anyway, the files seem to use HTML5 style booleans already, so it's not
-		# going to be any worse.)
-		f.write(soup.encode(formatter="html5"))
+			pending_fixes[context] += 1
+
+# Directories that have been listed in search of letter-case fixes, each one
+# listed only once: the casefolded names of its files mapped to the real ones,
+# or None if there's no such directory.
+dir_listings = { }
+
+def casefold_listing(dir):
+	if dir not in dir_listings:
+		try: dir_listings[dir] = {f.casefold(): f for f in os.listdir(dir)}
+		except FileNotFoundError:
+			dir_listings[dir] = None # Neither a true match nor a false one. Can't be autofixed.
+	return dir_listings[dir]
+
+# Candidates for where a broken link should have pointed, drawn from every file
+# in the site (see weakest_link.py for building all_files.txt). File names are
+# indexed by the character trigrams of their stems (extensions would make every
+# .html file look alike), so that similar names can be found without comparing
+# against every file. Built on first use.
+file_index = None
+SUGGESTIONS = 5
+COMMON_TRIGRAM = 2000 # Trigrams in more names than this are too common to help
+
+def trigrams(stem):
+	stem = " " + stem + " " # Let the start and end of the name count for something
+	return {stem[i:i + 3] for i in range(len(stem) - 2)}
+
+def build_file_index():
+	names = collections.defaultdict(list) # Casefolded base name: [fn, fn, ...]
+	try:
+		with open(root + "/backups/all_files.txt") as f:
+			for line in f:
+				fn = "/" + line.strip().split("\t")[0]
+				names[fn.rpartition("/")[2].casefold()].append(fn)
+	except FileNotFoundError: pass # No manifest, no suggestions
+	grams = collections.defaultdict(list) # Trigram: [name, name, ...]
+	sizes = { } # Name: number of trigrams
+	for name in names:
+		stem = trigrams(name.rpartition(".")[0] or name)
+		sizes[name] = len(stem)
+		for gram in stem: grams[gram].append(name)
+	return names, grams, sizes
+
+def suggest(target):
+	global file_index
+	if file_index is None: file_index = build_file_index()
+	names, grams, sizes = file_index
+	# Link targets are as written in the page, but the manifest has plain file names.
+	dir, _, name = urllib.parse.unquote(target).casefold().rpartition("/")
+	stem, _, ext = name.rpartition(".")
+	if not stem: stem, ext = name, ""
+	wanted = trigrams(stem)
+	shared = collections.Counter()
+	for gram in wanted:
+		if len(grams.get(gram, ())) <= COMMON_TRIGRAM: shared.update(grams.get(gram, ()))
+	score = { }
+	for n, count in shared.items():
+		# Jaccard similarity of the stems
+		score[n] = count / (len(wanted) + sizes[n] - count)
+	if name in names: score[name] = 2 # Exact match (other than case) beats everything
+	# Rank by similarity, then whether the extension matches, then by how much
+	# of the target's directory is shared.
+	dirparts = dir.split("/")
+	def rank(fn):
+		parts = fn.casefold().split("/")
+		common = 0
+		while common < min(len(parts) - 1, len(dirparts)) and parts[common] == dirparts[common]: common += 1
+		return -score[parts[-1]], not parts[-1].endswith("." + ext), -common, fn
+	best = sorted(score, key=lambda n: (-score[n], not n.endswith("." + ext)))[:SUGGESTIONS]
+	return sorted((fn for n in best for fn in names[n]), key=rank)[:SUGGESTIONS]
 
 @handler("Internal link not found")
 def intlink(type, context, url, extra):
@@ -112,20 +375,20 @@ def intlink(type, context, url, extra):
 		# the ref is right and the file wrong or the other way around, but since
 		# it's safer to change a link than a file, we'll go with that.
 		p = root + extra[0]
-		fn = os.path.basename(p).casefold()
-		try:
-			for f in os.listdir(os.path.dirname(p)):
-				if f.casefold() == fn: fixed = f
-		except FileNotFoundError:
-			pass # Neither a true match nor a false one. Can't be autofixed.
+		listing = casefold_listing(os.path.dirname(p))
+		if listing: fixed = listing.get(os.path.basename(p).casefold())
 		if fixed:
 			# Reconstruct the original (possibly relative) URL
 			fixed = os.path.join(os.path.dirname(url), fixed)
 
-	if not fixed: return # Sometimes a thing gets broke, can't be fixed.
-	# But if it can, and if the file exists (this only fixes internal links), go for it.
-	if os.path.exists(root + urllib.parse.urljoin(context, fixed)):
+	# Sometimes a thing gets broke, can't be fixed. But if it can, and if the file
+	# exists (this only fixes internal links), go for it.
+	if fixed and os.path.exists(root + urllib.parse.urljoin(context, fixed)):
 		autofix(type, context, url, [fixed])
+		return
+	# Otherwise, offer up some likely targets for a human to choose from.
+	if candidates := suggest(extra[0]):
+		print("SUGGEST", context, url, "->", ", ".join(candidates))
 
 @handler("Local file link")
 def locallink(type, context, url, extra):
@@ -155,13 +418,26 @@ def unscanned_dupe(type, context, url, extra):
 			os.unlink(root + url)
 
 try:
-	with open("weakest_link.log") as log:
-		for line in log:
-			if not line: continue
-			type, context, url, *extra = json.loads(line)
-			if type in handlers: handlers[type](type, context, url, extra)
+	if sys.argv[1:2] == ["--probe"]:
+		# Probe just the URLs given (even if already known), eg to try this against a
+		# local test server. Run it somewhere other than the usual directory to keep
+		# the results out of the real config.
+		to_probe.update(dict.fromkeys(sys.argv[2:]))
+	else:
+		with open("weakest_link.log") as log:
+			for line in log:
+				if not line: continue
+				type, context, url, *extra = json.loads(line)
+				if type in handlers: handlers[type](type, context, url, extra)
+	probe_all(to_probe)
 except KeyboardInterrupt: pass # Halting should be safe any time
 finally:
 	# Always save the configs, even if we bomb with an error
 	with open("weakest_link.json", "w") as f:
 		json.dump(config, f, indent=4, sort_keys=True)
+	# Likewise, anything that got fixed is fixed properly, so write it out.
+	for context in list(pending_fixes): write_back(context)
+	for context, count in sorted(fixes_written.items()):
+		print("%4d %s" % (count, context))
+	print("Fixed %d links in %d files" % (fixes_written.total(), len(fixes_written)))
+	print("Soup cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions" % soup_stats)